@@ -1,10 +1,65 @@
+import argparse
+import functools
 import os
+import re
+import threading
 import time
-from urllib.parse import urljoin, urlparse
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse, urlsplit
 
+import charset_normalizer
+import lxml.html
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+import xlsxwriter
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 同一ホストへの接続を使い回すための共有セッション（TCP/TLSハンドシェイクを省略）
+# brotli パッケージが入っていれば Accept-Encoding に br も自動で付与され、転送量が減る
+# 429 はホスト単位で待機させるため、ここでは再試行せず HostRateLimiter 側で扱う
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "Mozilla/5.0 (compatible; googleMapInfo-crawler/1.0)"})
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504]),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+MAX_WORKERS = 10  # 同時に取得するページ数
+REQUESTS_PER_SECOND = 1  # サーバー負荷低減のためのホストごとの1秒あたりの最大リクエスト数
+MAX_RATE_LIMIT_RETRIES = 3  # 429 を受けたときの再試行回数
+DEFAULT_RETRY_AFTER = 5.0  # Retry-After が無い・解釈できない場合の待機秒数
+MAX_RETRY_AFTER = 60.0  # Retry-After で待機する最大秒数
+MAX_PAGE_BYTES = 2_000_000  # 1ページあたりに読み込む最大バイト数
+CHUNK_SIZE = 65536  # レスポンス本文を読み込む単位
+HTML_CONTENT_TYPES = frozenset({"", "text/html", "application/xhtml+xml"})
+RESULT_COLUMNS = ["店舗名", "StoreURL", "PageURL", "Title", "Instagram"]  # 出力ファイルの列
+
+# リンク判定用の事前コンパイル済みパターン（スキーム、ホスト、パスを取り出す）
+HREF_RE = re.compile(r'^(?:(https?):)?//([^/?#]+)([^?#]*)', re.I)
+SKIP_HREF_PREFIXES = ("#", "mailto:", "tel:", "javascript:")
+INSTAGRAM_HOSTS = frozenset({"instagram.com", "www.instagram.com"})
+MULTI_SLASH_RE = re.compile(r'/{2,}')
+DEFAULT_PORT_SUFFIXES = {"http": ":80", "https": ":443"}  # スキームごとの既定ポート
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset', re.I)
+META_SNIFF_BYTES = 4096  # <meta charset> を探す先頭バイト数
+
+# ページ解析用に使い回すパーサーとコンパイル済みXPath（解析は crawl_website を呼んだスレッドでのみ行う）
+# コメントや処理命令は必要ないので木に含めず、生成するノード数を減らす
+# 文字コードが判明したページはUTF-8に変換して渡し、不明なページは<meta charset>の判定をlxmlに任せる
+HTML_PARSERS = {
+    None: lxml.html.HTMLParser(remove_comments=True, remove_pis=True),
+    "utf-8": lxml.html.HTMLParser(encoding="utf-8", remove_comments=True, remove_pis=True),
+}
+TITLE_XPATH = etree.XPath("/html/head/title/text()")
+HREF_XPATH = etree.XPath("//a/@href")
 
 
 def is_valid_url(url):
@@ -15,85 +70,309 @@ def is_valid_url(url):
     except Exception:
         return False
 
+@functools.lru_cache(maxsize=4096)
+def _split_absolute_link(href, page_scheme, page_netloc):
+    """
+    現在のページに依存しないhref（絶対URL・スキーム省略URL・ルート相対パス）を分解する関数
+    ナビゲーションメニューなど同じhrefが何度も現れるため結果をキャッシュする
+    相対パスの場合は None を返す
+    """
+    # 現在のページと同じホストの絶対URLは、URLを解析せず文字列操作だけで処理する
+    page_prefix = f"{page_scheme}://{page_netloc}"
+    if href.startswith(page_prefix):
+        rest = href[len(page_prefix):]
+        if not rest or rest[0] in "/?#":
+            return page_netloc, page_prefix + rest.split("?", 1)[0].split("#", 1)[0]
+    # 絶対URL・スキーム省略URLは正規表現だけで分解する
+    match = HREF_RE.match(href)
+    if match:
+        scheme, host, path = match.groups()
+        scheme = scheme.lower() if scheme else page_scheme
+        return host, f"{scheme}://{host}{path}"
+    # ルート相対パスは現在のホストに連結する
+    if href.startswith("/"):
+        path = href.split("?", 1)[0].split("#", 1)[0]
+        return page_netloc, f"{page_prefix}{path}"
+    return None
+
+def split_link(href, page_url, page_scheme, page_netloc):
+    """
+    hrefを(ホスト, パラメーター・フラグメントを除いたURL)に分解する関数
+    クロール対象にならないリンクの場合は None を返す
+    """
+    if href.startswith(SKIP_HREF_PREFIXES):
+        return None
+    # "/./" や "/../" を含むパスは urljoin でドットセグメントを解決させる
+    if "/." not in href:
+        link = _split_absolute_link(href, page_scheme, page_netloc)
+        if link is not None:
+            return link
+    # それ以外（相対パスなど）は urljoin で絶対URLに変換
+    parsed_href = urlparse(urljoin(page_url, href))
+    return parsed_href.netloc, f"{parsed_href.scheme}://{parsed_href.netloc}{parsed_href.path}"
+
+def canonicalize_netloc(scheme, netloc):
+    """ホスト名を小文字にし、スキームの既定ポート（http の :80 / https の :443）を取り除く関数"""
+    netloc = netloc.lower()
+    default_port = DEFAULT_PORT_SUFFIXES.get(scheme.lower())
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return netloc
+
+@functools.lru_cache(maxsize=4096)
+def canonicalize_url(url):
+    """
+    重複判定用にURLを正規化する関数
+    ホストの小文字化、既定ポート・連続スラッシュ・末尾スラッシュの除去を行う
+    """
+    parts = urlsplit(url)
+    path = MULTI_SLASH_RE.sub("/", parts.path) or "/"
+    if path != "/" and path.endswith("/"):
+        path = path[:-1]
+    return f"{parts.scheme.lower()}://{canonicalize_netloc(parts.scheme, parts.netloc)}{path}"
+
+def is_instagram_host(host):
+    """ホストがInstagramのものか判定する関数"""
+    host = host.lower()
+    return host in INSTAGRAM_HOSTS or host.endswith(".instagram.com")
+
+class HostRateLimiter:
+    """
+    ホストごとに直近1秒間のリクエスト数を制限するスレッドセーフなレートリミッター
+    429 を受けたホストは backoff() で指定時間リクエストを止める
+    """
+
+    def __init__(self, rate, window=1.0):
+        self.rate = rate
+        self.window = window
+        self.lock = threading.Lock()
+        self.hosts = {}  # ホスト -> (直近のリクエスト時刻の deque, ホストごとのロック)
+        self.blocked_until = {}  # ホスト -> リクエストを再開できる時刻
+
+    def _host_state(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = (deque(), threading.Lock())
+            return state
+
+    def wait(self, host):
+        """指定ホストへのリクエスト枠が空くまで待機する"""
+        timestamps, host_lock = self._host_state(host)
+        with host_lock:
+            while True:
+                now = time.monotonic()
+                # 直近 window 秒より古いリクエスト時刻を捨てる
+                while timestamps and now - timestamps[0] >= self.window:
+                    timestamps.popleft()
+                delay = self.blocked_until.get(host, 0.0) - now
+                if delay <= 0:
+                    if len(timestamps) < self.rate:
+                        timestamps.append(now)
+                        return
+                    delay = self.window - (now - timestamps[0])
+                time.sleep(delay)
+
+    def backoff(self, host, seconds):
+        """指定ホストへのリクエストを seconds 秒間止める"""
+        with self.lock:
+            until = time.monotonic() + seconds
+            self.blocked_until[host] = max(self.blocked_until.get(host, 0.0), until)
+
+HOST_LIMITER = HostRateLimiter(REQUESTS_PER_SECOND)
+
+def parse_retry_after(value):
+    """Retry-After ヘッダー（秒数またはHTTP日付）を待機秒数に変換する関数"""
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+def get_charset(content_type_header):
+    """Content-Type ヘッダーの charset パラメーターを返す関数（無い場合は None）"""
+    for param in content_type_header.split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "charset":
+            return value.strip().strip("'\"") or None
+    return None
+
+def decode_html(body, charset):
+    """
+    HTML本文の文字コードを決め、(本文, lxmlに渡す文字コード) を返す関数
+    ヘッダーの charset を優先し、ヘッダーにも<meta charset>にも無い場合は本文から推定する
+    文字コードが決まった場合はUTF-8に変換して "utf-8" を、決まらない場合は元のバイト列と None を返す
+    """
+    if charset is None and not META_CHARSET_RE.search(body[:META_SNIFF_BYTES]):
+        best = charset_normalizer.from_bytes(body).best()
+        charset = best.encoding if best else None
+    if charset is None:
+        return body, None
+    try:
+        return body.decode(charset, errors="replace").encode("utf-8"), "utf-8"
+    except LookupError:
+        # Pythonが知らない文字コード名の場合は lxml の判定に任せる
+        return body, None
+
+def read_html(response):
+    """
+    レスポンスがHTMLなら (本文（最大 MAX_PAGE_BYTES バイト）, lxmlに渡す文字コード) を返し、
+    それ以外は None を返す関数
+    PDFや画像などHTML以外は本文をダウンロードせずに打ち切る
+    """
+    content_type_header = response.headers.get("Content-Type", "")
+    content_type = content_type_header.split(";", 1)[0].strip().lower()
+    if content_type not in HTML_CONTENT_TYPES:
+        return None
+
+    chunks = []
+    total = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= MAX_PAGE_BYTES:
+            break
+    return decode_html(b"".join(chunks), get_charset(content_type_header))
+
+def fetch_page(url):
+    """
+    ホストごとのレート制限を守りつつページを取得する関数（ワーカースレッドで実行）
+    HTMLの場合は (本文, 文字コード) を返し、それ以外は None を返す
+    """
+    parts = urlsplit(url)
+    host = canonicalize_netloc(parts.scheme, parts.netloc)
+    for _ in range(MAX_RATE_LIMIT_RETRIES + 1):
+        HOST_LIMITER.wait(host)
+        with SESSION.get(url, timeout=(3.05, 10), stream=True) as response:
+            if response.status_code == 429:
+                # Retry-After の間はこのホストへのリクエストをすべて止めてから再試行する
+                HOST_LIMITER.backoff(host, parse_retry_after(response.headers.get("Retry-After")))
+                continue
+            response.raise_for_status()
+            return read_html(response)
+    raise requests.HTTPError(f"429 Too Many Requests (retried {MAX_RATE_LIMIT_RETRIES} times): {url}")
+
 def crawl_website(root_url):
     """
     指定したルートURL以下の内部ページを再帰的にクロールし、
     各ページのURL、タイトル、及びInstagramリンクを取得する関数
     """
-    visited = set()      # 訪問済みURLのセット
     pages = []           # 各ページの情報を格納するリスト
-    to_visit = [root_url]  # クロール対象のURLリスト
+    to_visit = deque([root_url])  # クロール対象のURLキュー
+    # 訪問済み・キュー追加済みのURLのセット（キューに入れた時点で登録し、重複取得を防ぐ）
+    # 表記ゆれで同じページを何度も取得しないよう、正規化したURLで管理する
+    seen = {canonicalize_url(root_url)}
 
     # ルートURLのドメイン情報を取得
     parsed_root = urlparse(root_url)
-    base_netloc = parsed_root.netloc
+    base_netloc = canonicalize_netloc(parsed_root.scheme, parsed_root.netloc)
 
-    while to_visit:
-        current_url = to_visit.pop(0)
-        if current_url in visited:
-            continue
-        visited.add(current_url)
-        print(f"Visiting: {current_url}")
+    # ページ取得はスレッドプールで並列に行い、解析とキュー操作はこのスレッドでのみ行う
+    # 1件取得が終わるたびに空いたワーカーへ次のURLを渡し、常に最大 MAX_WORKERS 件を取得中に保つ
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        in_flight = {}  # 取得中の Future -> URL
+        while to_visit or in_flight:
+            while to_visit and len(in_flight) < MAX_WORKERS:
+                url = to_visit.popleft()
+                print(f"Visiting: {url}")
+                in_flight[executor.submit(fetch_page, url)] = url
 
-        try:
-            response = requests.get(current_url, timeout=10)
-            response.raise_for_status()
-        except Exception as e:
-            print(f"Error fetching {current_url}: {e}")
-            continue
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                current_url = in_flight.pop(future)
+                try:
+                    page = future.result()
+                except Exception as e:
+                    print(f"Error fetching {current_url}: {e}")
+                    continue
+                if page is None:
+                    print(f"Skipping non-HTML page: {current_url}")
+                    continue
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+                # lxmlで解析し、必要なタイトルとhref属性だけをXPathで文字列として取り出す
+                content, encoding = page
+                try:
+                    root = lxml.html.document_fromstring(content, parser=HTML_PARSERS[encoding])
+                except (etree.ParserError, ValueError) as e:
+                    print(f"Error parsing {current_url}: {e}")
+                    continue
 
-        # ページタイトルの取得
-        title = ""
-        if soup.title and soup.title.string:
-            title = soup.title.string.strip()
+                # ページタイトルの取得
+                title_texts = TITLE_XPATH(root)
+                title = title_texts[0].strip() if title_texts else ""
 
-        # Instagramリンクを収集（重複除去のため set で管理）
-        instagram_links = set()
+                # Instagramリンクを収集（重複除去のため set で管理）
+                instagram_links = set()
+                parsed_page = urlparse(current_url)
 
-        # ページ内のすべての<a>タグからリンクを抽出
-        for a_tag in soup.find_all("a"):
-            href = a_tag.get("href")
-            if not href:
-                continue
+                # ページ内のすべての<a>タグのhrefからリンクを抽出
+                for href in HREF_XPATH(root):
+                    if not href:
+                        continue
 
-            # 相対パスの場合は絶対URLに変換
-            absolute_href = urljoin(current_url, href)
-            parsed_href = urlparse(absolute_href)
-            # URLのパラメーターやフラグメントは除去
-            clean_href = f"{parsed_href.scheme}://{parsed_href.netloc}{parsed_href.path}"
-
-            # Instagramリンクの場合は専用に追加
-            if "instagram.com" in parsed_href.netloc:
-                instagram_links.add(clean_href)
-            else:
-                # 内部リンクの場合、ルートと同じドメインならクロール対象に追加
-                if parsed_href.netloc == base_netloc:
-                    if clean_href not in visited and clean_href not in to_visit:
-                        to_visit.append(clean_href)
-        # 現在のページ情報をリストに追加
-        pages.append({
-            "PageURL": current_url,
-            "Title": title,
-            "Instagram": ", ".join(instagram_links)
-        })
-        # サーバー負荷低減のため1秒待機
-        time.sleep(1)
+                    # URLのパラメーターやフラグメントは除去して絶対URLに変換
+                    link = split_link(
+                        href.strip(), current_url, parsed_page.scheme, parsed_page.netloc
+                    )
+                    if link is None:
+                        continue
+                    host, clean_href = link
+
+                    # Instagramリンクの場合は専用に追加
+                    if is_instagram_host(host):
+                        instagram_links.add(canonicalize_url(clean_href))
+                    else:
+                        # 内部リンクの場合、ルートと同じドメインならクロール対象に追加
+                        # （重複判定は正規化URLで行い、取得には元のURLを使う）
+                        link_scheme = clean_href.partition(":")[0]
+                        if canonicalize_netloc(link_scheme, host) == base_netloc:
+                            canonical_href = canonicalize_url(clean_href)
+                            if canonical_href not in seen:
+                                seen.add(canonical_href)
+                                to_visit.append(clean_href)
+                # 現在のページ情報をリストに追加
+                pages.append({
+                    "PageURL": current_url,
+                    "Title": title,
+                    "Instagram": ", ".join(instagram_links)
+                })
     return pages
 
 def save_pages_to_excel(pages, filename):
-    """ページ情報のリストをExcelファイルに出力する関数"""
-    df = pd.DataFrame(pages)
-    df.to_excel(filename, index=False)
-    print(f"Saved {len(pages)} records to {filename}")
+    """ページ情報（行の辞書のリスト、列名→値リストの辞書、またはDataFrame）をExcelファイルに出力する関数"""
+    df = pd.DataFrame(pages).fillna("")
+    # xlsxwriter の constant_memory モードで行ごとにディスクへ書き出し、ワークブック全体をメモリに保持しない
+    # （このモードは行順に書く必要があり、列ごとに書く pandas の to_excel は使えないため1行ずつ書き込む）
+    # URL文字列はハイパーリンクに変換せず文字列のまま書く（ハイパーリンクはシートあたりの上限や長さ制限で欠落するため）
+    with xlsxwriter.Workbook(filename, {"constant_memory": True, "strings_to_urls": False}) as workbook:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, df.columns)
+        for row_idx, row in enumerate(df.itertuples(index=False), start=1):
+            worksheet.write_row(row_idx, 0, row)
+    print(f"Saved {len(df)} records to {filename}")
+
+def parse_args(default_output):
+    """コマンドライン引数を解析する関数（開始番号・件数が無い場合は実行時に入力を求める）"""
+    parser = argparse.ArgumentParser(description="店舗ウェブサイトをクロールしてInstagramリンクを収集する")
+    parser.add_argument("--start", type=int, help="取得開始店舗番号（1からの番号）")
+    parser.add_argument("--count", type=int, help="取得する店舗件数")
+    parser.add_argument("--out", default=default_output, help="出力するExcelファイルのパス")
+    return parser.parse_args()
 
 if __name__ == "__main__":
     # srcフォルダ内のスクリプトのディレクトリを取得
     script_dir = os.path.dirname(os.path.abspath(__file__))
     # 親ディレクトリ内の data フォルダ内の Excel ファイルのパスを構築
     input_file = os.path.join(script_dir, "..", "data", "indoor_golf_places_sorted.xlsx")
-    
+    # 出力ファイルの既定パスは、親ディレクトリ内の data フォルダ
+    args = parse_args(os.path.join(script_dir, "..", "data", "crawled_indoor_golf_websites.xlsx"))
+
     try:
         stores_df = pd.read_excel(input_file)
         print(f"Excelファイルの読み込みに成功しました: {input_file}")
@@ -106,10 +385,10 @@ if __name__ == "__main__":
         print("Excelファイルに店舗データがありません。")
         exit(1)
 
-    # 取得する店舗データの開始位置（1-indexed）と件数をユーザーに入力してもらう
+    # 取得する店舗データの開始位置（1-indexed）と件数は引数で指定し、無ければユーザーに入力してもらう
     try:
-        start_index = int(input("取得開始店舗番号（1からの番号、例：3）: "))
-        count = int(input("取得する店舗件数（例：5）: "))
+        start_index = args.start if args.start is not None else int(input("取得開始店舗番号（1からの番号、例：3）: "))
+        count = args.count if args.count is not None else int(input("取得する店舗件数（例：5）: "))
     except Exception as e:
         print(f"入力エラー: {e}")
         exit(1)
@@ -122,7 +401,13 @@ if __name__ == "__main__":
     selected_stores_df = stores_df.iloc[start_idx:end_idx]
     print(f"店舗データ {start_index} 番目から {start_index + count - 1} 番目を処理します。")
 
-    all_results = []
+    # 店舗ごとの結果は出力先と同じフォルダの partial フォルダへ随時CSVで書き出す
+    # （途中で止まってもそれまでの結果が残り、全件をメモリに保持しない）
+    output_file = args.out
+    partial_dir = os.path.join(os.path.dirname(os.path.abspath(output_file)), "partial")
+    os.makedirs(partial_dir, exist_ok=True)
+    partial_files = []
+
     # 各店舗の「ウェブサイト」URLに対してクローラーを実行
     for idx, row in selected_stores_df.iterrows():
         store_name = row.get("店舗名", "")
@@ -137,17 +422,33 @@ if __name__ == "__main__":
 
         print(f"Processing 店舗: {store_name} | URL: {website_url}")
         pages = crawl_website(website_url)
-        # 各ページ情報に店舗情報を追加して結果リストにまとめる
+        # 各ページ情報に店舗情報を追加し、列ごとのリストにまとめる
+        store_results = {column: [] for column in RESULT_COLUMNS}
         for page in pages:
-            result = {
-                "店舗名": store_name,
-                "StoreURL": website_url,
-                "PageURL": page.get("PageURL", ""),
-                "Title": page.get("Title", ""),
-                "Instagram": page.get("Instagram", "")
-            }
-            all_results.append(result)
-    
-    # 出力ファイルのパスを、親ディレクトリ内の data フォルダに設定
-    output_file = os.path.join(script_dir, "..", "data", "crawled_indoor_golf_websites.xlsx")
+            result = (
+                store_name,
+                website_url,
+                page.get("PageURL", ""),
+                page.get("Title", ""),
+                page.get("Instagram", ""),
+            )
+            for values, value in zip(store_results.values(), result):
+                values.append(value)
+
+        partial_file = os.path.join(partial_dir, f"{idx + 1:05d}.csv")
+        pd.DataFrame(store_results).to_csv(partial_file, index=False)
+        partial_files.append(partial_file)
+
+    # 今回書き出した店舗ごとの結果を結合してExcelに変換
+    if partial_files:
+        all_results = pd.concat(
+            [pd.read_csv(f, dtype=str, keep_default_na=False) for f in partial_files],
+            ignore_index=True,
+        )
+    else:
+        all_results = pd.DataFrame(columns=RESULT_COLUMNS)
     save_pages_to_excel(all_results, output_file)
+
+    # Excelへの保存が完了したら途中結果は不要なので削除
+    for f in partial_files:
+        os.remove(f)
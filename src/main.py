@@ -1,8 +1,12 @@
-import math
+import functools
 import os
+import shelve
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import googlemaps
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 
@@ -10,29 +14,56 @@ from dotenv import load_dotenv
 load_dotenv()
 API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 
-# 📌 Google Maps クライアントを作成
-gmaps = googlemaps.Client(key=API_KEY)
+# 📌 APIリクエストの並列数と1秒あたりの上限（Google の QPS 制限内に収める）
+MAX_WORKERS = 8
+QUERIES_PER_SECOND = 10
+
+# 📌 Google Maps クライアントを作成（全スレッドで共有）
+gmaps = googlemaps.Client(key=API_KEY, queries_per_second=QUERIES_PER_SECOND)
+
+# 📌 クライアント内蔵のQPS制限はスレッドセーフではないため、呼び出し側でロック付きで間隔を空ける
+_api_lock = threading.Lock()
+_next_api_time = 0.0
 
 # 📌 JR東加古川駅の緯度・経度
 LOCATION = (34.7344, 134.8652)  # 東加古川駅の座標
 RADIUS = 50000  # 半径50km
 KEYWORD = "インドアゴルフ"  # 検索キーワード
 
+# 📌 APIレスポンスのディスクキャッシュ（再実行時に同じ問い合わせを繰り返さない）
+# Google Maps Platform の規約上、キャッシュは最大30日までとし、それを過ぎたら取得し直す
+CACHE_FILE = ".gmaps_cache"
+CACHE_TTL = 30 * 24 * 60 * 60  # キャッシュの有効期間（秒）
+COORD_PRECISION = 4  # 逆ジオコーディングのキーに使う小数桁数（約11m単位）
+_cache = shelve.open(CACHE_FILE)
+_cache_lock = threading.Lock()
+
+# 📌 出力する列（enrich が返す値の順番と対応）
+COLUMNS = (
+    "店舗名",
+    "住所",
+    "評価",
+    "口コミ数",
+    "ウェブサイト",
+    "距離（km）",
+    "Googleマップリンク",
+)
+
 
 def haversine(lat1, lon1, lat2, lon2):
-    """2点間のハーサイン距離（km）を計算"""
+    """2点間のハーサイン距離（km）を計算（NumPy配列を渡すと全点をまとめて計算）"""
     R = 6371.0  # 地球の半径（km）
-    lat1_rad, lon1_rad = math.radians(lat1), math.radians(lon1)
-    lat2_rad, lon2_rad = math.radians(lat2), math.radians(lon2)
+    lat1_rad, lon1_rad = np.radians(lat1), np.radians(lon1)
+    lat2_rad, lon2_rad = np.radians(lat2), np.radians(lon2)
 
     dlat = lat2_rad - lat1_rad
     dlon = lon2_rad - lon1_rad
 
     a = (
-        math.sin(dlat / 2) ** 2
-        + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
+        np.sin(dlat / 2) ** 2
+        + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlon / 2) ** 2
     )
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    c = 2 * np.arcsin(np.sqrt(a))
 
     return R * c
 
@@ -67,12 +98,53 @@ def get_places(query, location, radius):
     return results
 
 
+def _throttle():
+    """全スレッド合計で QUERIES_PER_SECOND を超えないよう、API呼び出し前に待機する"""
+    global _next_api_time
+    with _api_lock:
+        now = time.monotonic()
+        wait_time = _next_api_time - now
+        _next_api_time = max(now, _next_api_time) + 1.0 / QUERIES_PER_SECOND
+    if wait_time > 0:
+        time.sleep(wait_time)
+
+
+def _cached(key, fetch):
+    """ディスクキャッシュに有効期間内の結果があれば返し、無ければ fetch() を呼んで保存する"""
+    with _cache_lock:
+        entry = _cache.get(key)
+    if isinstance(entry, tuple) and len(entry) == 2:
+        cached_at, value = entry
+        if time.time() - cached_at < CACHE_TTL:
+            return value
+    value = fetch()
+    with _cache_lock:
+        _cache[key] = (time.time(), value)
+    return value
+
+
+@functools.lru_cache(maxsize=4096)
+def _reverse_geocode(lat_r, lng_r):
+    """丸めた緯度・経度で逆ジオコーディングし、最初の住所（無ければ None）を返す"""
+
+    def fetch():
+        _throttle()
+        result = gmaps.reverse_geocode((lat_r, lng_r), language="ja")
+        return result[0]["formatted_address"] if result else None
+
+    return _cached(f"geocode:{lat_r},{lng_r}", fetch)
+
+
 def get_place_details(place_id):
     """詳細情報（ウェブサイト・口コミ数）を取得"""
     try:
-        details = gmaps.place(
-            place_id=place_id, fields=["website", "user_ratings_total"]
-        )
+        def fetch():
+            _throttle()
+            return gmaps.place(
+                place_id=place_id, fields=["website", "user_ratings_total"]
+            )
+
+        details = _cached(f"place:{place_id}", fetch)
         return {
             "ウェブサイト": details.get("result", {}).get("website", "なし"),
             "口コミ数": details.get("result", {}).get("user_ratings_total", "N/A"),
@@ -85,53 +157,57 @@ def get_place_details(place_id):
 def get_full_address(lat, lng):
     """緯度・経度から漢字の住所を取得"""
     try:
-        reverse_geocode_result = gmaps.reverse_geocode((lat, lng), language="ja")
-        if reverse_geocode_result:
-            return reverse_geocode_result[0]["formatted_address"]
-        else:
-            return "住所不明"
+        address = _reverse_geocode(
+            round(lat, COORD_PRECISION), round(lng, COORD_PRECISION)
+        )
+        return address if address else "住所不明"
     except Exception as e:
         print(f"住所取得エラー: {e}")
         return "住所不明"
 
 
-# 📌 店舗情報を取得
-places = get_places(KEYWORD, LOCATION, RADIUS)
-
-# 📌 店舗情報を整理してデータリストに格納
-data_list = []
-for place in places:
+def enrich(place, distance):
+    """1店舗分の詳細情報・住所を取得し、COLUMNS の順に値を並べたタプルを返す"""
     place_id = place["place_id"]
     details = get_place_details(place_id)
     address = get_full_address(
         place["geometry"]["location"]["lat"], place["geometry"]["location"]["lng"]
     )
 
-    # 距離計算（東加古川駅からの距離）
-    distance = haversine(
-        LOCATION[0],
-        LOCATION[1],
-        place["geometry"]["location"]["lat"],
-        place["geometry"]["location"]["lng"],
-    )
-
     # Googleマップリンクを生成
     google_maps_link = f"https://www.google.com/maps/place/?q=place_id:{place_id}"
 
-    data_list.append(
-        {
-            "店舗名": place["name"],
-            "住所": address,
-            "評価": place.get("rating", "N/A"),
-            "口コミ数": details["口コミ数"],
-            "ウェブサイト": details["ウェブサイト"],
-            "距離（km）": round(distance, 2),
-            "Googleマップリンク": google_maps_link,  # Googleマップのリンク
-        }
+    return (
+        place["name"],
+        address,
+        place.get("rating", "N/A"),
+        details["口コミ数"],
+        details["ウェブサイト"],
+        round(float(distance), 2),
+        google_maps_link,  # Googleマップのリンク
     )
 
+
+# 📌 店舗情報を取得
+places = get_places(KEYWORD, LOCATION, RADIUS)
+
+# 📌 距離計算（東加古川駅からの距離）を全店舗分まとめて実行
+lats = np.array([place["geometry"]["location"]["lat"] for place in places])
+lngs = np.array([place["geometry"]["location"]["lng"] for place in places])
+distances = haversine(LOCATION[0], LOCATION[1], lats, lngs)
+
+# 📌 店舗ごとのAPI呼び出しを並列実行し、列ごとのリストに店舗情報を整理
+columns = {name: [] for name in COLUMNS}
+try:
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for row in executor.map(enrich, places, distances):
+            for values, value in zip(columns.values(), row):
+                values.append(value)
+finally:
+    _cache.close()
+
 # 📌 距離順に並び替え
-df = pd.DataFrame(data_list)
+df = pd.DataFrame(columns)
 df_sorted = df.sort_values(by="距離（km）", ascending=True)
 
 # 📌 検索結果をExcelに出力